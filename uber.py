@@ -1,11 +1,18 @@
 import panel as pn
 import pandas as pd
+import numpy as np
 import hvplot.pandas
+import holoviews as hv
+import os
+import glob
+import hashlib
 import warnings
 import datetime as dt
+from functools import lru_cache
 from prophet import Prophet
 
 warnings.filterwarnings("ignore")
+pd.options.mode.copy_on_write = True
 pn.extension('tabulator', 'echarts', 'bokeh')
 
 # =================== CSS for smaller numbers ===================
@@ -16,99 +23,258 @@ pn.config.raw_css.append("""
 """)
 
 # =================== Load Data ===================
-df_uber = pd.read_csv("./data/csv/ncr_ride_bookings.csv")
-
-df_uber = df_uber[['Date', 'Time', 'Booking ID', 'Booking Status', 'Customer ID',   
-                   'Vehicle Type', 'Pickup Location', 'Drop Location', 'Ride Distance',     
-                   'Driver Ratings', 'Customer Rating', 'Payment Method']]
+UBER_CSV = "./data/csv/ncr_ride_bookings.csv"
+UBER_PARQUET_DIR = "./data/parquet"
+
+UBER_COLUMNS = ['Date', 'Time', 'Booking ID', 'Booking Status', 'Customer ID',
+                'Vehicle Type', 'Pickup Location', 'Drop Location', 'Ride Distance',
+                'Driver Ratings', 'Customer Rating', 'Payment Method']
+
+UBER_DTYPES = {'Date': 'str', 'Time': 'str',
+               'Booking Status': 'category', 'Vehicle Type': 'category',
+               'Payment Method': 'category', 'Pickup Location': 'category',
+               'Drop Location': 'category', 'Ride Distance': 'float32',
+               'Driver Ratings': 'float32', 'Customer Rating': 'float32'}
+
+# The Parquet parse cache is named after the column/dtype spec and this version, so a
+# stale file is never reused; bump it when the Date/Hour derivation below changes.
+UBER_CACHE_VERSION = 1
+UBER_CACHE_KEY = hashlib.md5(repr((UBER_CACHE_VERSION, UBER_COLUMNS, UBER_DTYPES)).encode()).hexdigest()[:8]
+UBER_PARQUET = f"{UBER_PARQUET_DIR}/ncr_ride_bookings.{UBER_CACHE_KEY}.parquet"
+
+def convert_csv_to_parquet():
+    df = pd.read_csv(UBER_CSV, engine='pyarrow', usecols=UBER_COLUMNS, dtype=UBER_DTYPES)
+
+    # Date is read as text (see UBER_DTYPES) and only has one value per day
+    df['Date'] = df['Date'].astype('category')
+
+    # Time is always HH:MM:SS, so the hour is its first two characters
+    df['Hour'] = df['Time'].str.slice(0, 2).astype(np.int8)
+    df = df.drop(columns='Time')
+
+    # Write to a private file first so concurrent workers never read a partial Parquet
+    os.makedirs(UBER_PARQUET_DIR, exist_ok=True)
+    tmp_path = f"{UBER_PARQUET}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, UBER_PARQUET)
+
+    # Remove caches written for an older schema
+    for path in glob.glob(f"{UBER_PARQUET_DIR}/ncr_ride_bookings.*.parquet"):
+        if path != UBER_PARQUET:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def load_rides():
+    if not os.path.exists(UBER_PARQUET) or os.path.getmtime(UBER_PARQUET) < os.path.getmtime(UBER_CSV):
+        convert_csv_to_parquet()
+    return pd.read_parquet(UBER_PARQUET)
+
+# panel serve re-runs this script for every session; pn.state.as_cached keeps one
+# loaded copy per server process that all sessions share read-only
+df_uber = pn.state.as_cached('uber_rides', load_rides)
 
 df_uber_small = df_uber[['Date', 'Booking Status', 'Vehicle Type', 
                          'Pickup Location','Drop Location', 'Ride Distance',     
                          'Driver Ratings', 'Payment Method']]
 
-df_uber['Pickup Datetime'] = pd.to_datetime(df_uber['Date'] + ' ' + df_uber['Time'])
-df_uber['Hour'] = df_uber['Pickup Datetime'].dt.hour
+# Integer-coded filter columns, so filter_data compares int8 arrays instead of strings
+status_categories = df_uber['Booking Status'].cat.categories
+vehicle_categories = df_uber['Vehicle Type'].cat.categories
+status_codes = df_uber['Booking Status'].cat.codes.to_numpy()
+vehicle_codes = df_uber['Vehicle Type'].cat.codes.to_numpy()
+hour_arr = df_uber['Hour'].to_numpy(np.int8)
+date_categories = df_uber['Date'].cat.categories
+date_codes = df_uber['Date'].cat.codes.to_numpy()
+
+# =================== Aggregation Cubes ===================
+def count_codes(codes, shape):
+    # Rows with a missing key have code -1 and are left out, as groupby would drop them
+    valid = np.logical_and.reduce([c >= 0 for c in codes])
+    # np.bincount over the flattened (code, code, ...) index: one C pass, no hashing
+    flat = np.ravel_multi_index([c[valid] for c in codes], shape)
+    return np.bincount(flat, minlength=np.prod(shape)).reshape(shape).astype(np.int32)
+
+# Aggregates built once per server process and shared by every session; callbacks
+# slice these small tables instead of rescanning every ride.
+def build_cubes():
+    agg_cube = df_uber.groupby(['Booking Status', 'Vehicle Type', 'Hour'], observed=True).agg(
+        n=('Booking ID', 'size'),
+        dsum=('Ride Distance', 'sum'),
+        dcnt=('Ride Distance', 'count'),
+        rsum=('Driver Ratings', 'sum'),
+        rcnt=('Driver Ratings', 'count'),
+    )
+
+    pickup_cube = df_uber.groupby(['Booking Status', 'Vehicle Type', 'Hour', 'Pickup Location'], observed=True).size()
+    drop_cube = df_uber.groupby(['Booking Status', 'Vehicle Type', 'Hour', 'Drop Location'], observed=True).size()
+
+    # Ride counts indexed by [status code, vehicle code, hour]
+    ride_counts = count_codes((status_codes, vehicle_codes, hour_arr),
+                              (len(status_categories), len(vehicle_categories), 24))
+
+    # Ride distance histogram counts indexed by [status code, vehicle code, hour, bin],
+    # over 20 fixed bins spanning the full distance range
+    distance = df_uber['Ride Distance'].to_numpy()
+    has_distance = ~np.isnan(distance)
+    distance_edges = np.linspace(np.nanmin(distance), np.nanmax(distance), 21)
+    distance_bins = np.clip(np.searchsorted(distance_edges, distance[has_distance], side='right') - 1, 0, 19)
+    distance_hist = count_codes((status_codes[has_distance], vehicle_codes[has_distance],
+                                 hour_arr[has_distance], distance_bins),
+                                (len(status_categories), len(vehicle_categories), 24, 20))
+
+    # Ride counts indexed by [date code, status code, vehicle code, hour], for the forecast
+    daily_counts = count_codes((date_codes, status_codes, vehicle_codes, hour_arr),
+                               (len(date_categories), len(status_categories), len(vehicle_categories), 24))
+
+    return agg_cube, pickup_cube, drop_cube, ride_counts, distance_edges, distance_hist, daily_counts
+
+agg_cube, pickup_cube, drop_cube, ride_counts, distance_edges, distance_hist, daily_counts = \
+    pn.state.as_cached('uber_cubes', build_cubes)
+
+def code_slice(categories, value):
+    if value == "All":
+        return slice(None)
+    code = categories.get_loc(value)
+    return slice(code, code + 1)
+
+def slice_cube(cube, status, vehicle, hour_range):
+    start_hour, end_hour = hour_range
+    hours = cube.index.get_level_values('Hour')
+    keep = (hours >= start_hour) & (hours <= end_hour)
+    if status != "All":
+        keep &= cube.index.get_level_values('Booking Status') == status
+    if vehicle != "All":
+        keep &= cube.index.get_level_values('Vehicle Type') == vehicle
+    return cube[keep]
+
+def top_locations(cube, status, vehicle, hour_range, n):
+    counts = slice_cube(cube, status, vehicle, hour_range)
+    location = counts.index.names[-1]
+    return counts.groupby(level=location, observed=True).sum().nlargest(n)
 
 # =================== Widgets ===================
-status_select = pn.widgets.Select(name="Booking Status", options=["All"] + df_uber['Booking Status'].unique().tolist())
-vehicle_select = pn.widgets.Select(name="Vehicle Type", options=["All"] + df_uber['Vehicle Type'].unique().tolist())
+status_select = pn.widgets.Select(name="Booking Status", options=["All"] + status_categories.tolist())
+vehicle_select = pn.widgets.Select(name="Vehicle Type", options=["All"] + vehicle_categories.tolist())
 hour_slider = pn.widgets.IntRangeSlider(name='Hour of Day', start=0, end=23, value=(0,23), step=1, sizing_mode='stretch_width')
 
 # =================== Filter Function ===================
+# The callbacks fired by one widget change all call filter_data with the same values;
+# a tiny cache lets them share one result without holding on to stale frames.
+# Callers only read the returned frame and must not mutate it.
+@lru_cache(maxsize=2)
 def filter_data(status, vehicle, hour_range):
-    df = df_uber.copy()
+    start_hour, end_hour = hour_range
+    mask = (hour_arr >= start_hour) & (hour_arr <= end_hour)
     if status != "All":
-        df = df[df['Booking Status'] == status]
+        mask &= status_codes == status_categories.get_loc(status)
     if vehicle != "All":
-        df = df[df['Vehicle Type'] == vehicle]
-    start_hour, end_hour = hour_range
-    df = df[(df['Hour'] >= start_hour) & (df['Hour'] <= end_hour)]
-    return df
+        mask &= vehicle_codes == vehicle_categories.get_loc(vehicle)
+    return df_uber.iloc[mask]
 
 # =================== Metrics ===================
+METRIC_NAMES = ["Total Rides", "Completed", "Cancelled by Driver", "Cancelled by Customer",
+                "No Driver Found", "Incomplete", "Avg Ride Distance", "Avg Driver Rating"]
+
+# Created once; summary_metrics only updates their values
+metric_numbers = {name: pn.indicators.Number(name=name, value=0, width=45, height=30) for name in METRIC_NAMES}
+metrics_row = pn.Row(*metric_numbers.values(), sizing_mode='stretch_width', css_classes=['small-number'])
+
 def summary_metrics(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    total_rides = len(df)
-    completed = len(df[df['Booking Status']=="Complete"])
-    cancelled_driver = len(df[df['Booking Status']=="Cancelled by Driver"])
-    cancelled_customer = len(df[df['Booking Status']=="Cancelled by Customer"])
-    no_driver = len(df[df['Booking Status']=="No Driver Found"])
-    incomplete = len(df[df['Booking Status']=="Incomplete"])
-    avg_distance = df['Ride Distance'].mean() if not df.empty else 0
-    avg_driver_rating = df['Driver Ratings'].mean() if not df.empty else 0
-
-    numbers = [
-        pn.indicators.Number(name="Total Rides", value=total_rides, width=45, height=30),
-        pn.indicators.Number(name="Completed", value=completed, width=45, height=30),
-        pn.indicators.Number(name="Cancelled by Driver", value=cancelled_driver, width=45, height=30),
-        pn.indicators.Number(name="Cancelled by Customer", value=cancelled_customer, width=45, height=30),
-        pn.indicators.Number(name="No Driver Found", value=no_driver, width=45, height=30),
-        pn.indicators.Number(name="Incomplete", value=incomplete, width=45, height=30),
-        pn.indicators.Number(name="Avg Ride Distance", value=round(avg_distance,2), width=45, height=30),
-        pn.indicators.Number(name="Avg Driver Rating", value=round(avg_driver_rating,2), width=45, height=30)
-    ]
-
-    # return pn.Row(*numbers, sizing_mode='stretch_width', css_classes=['small-number'])
+    cube = slice_cube(agg_cube, status, vehicle, hour_range)
+    # One grouped pass over the slice; overall totals come from the per-status rows
+    status_totals = cube.groupby(level='Booking Status', observed=True).sum()
+    status_counts = status_totals['n']
+    totals = status_totals.sum()
+    total_rides = int(status_counts.sum())
+    completed = status_counts.get("Complete", 0)
+    cancelled_driver = status_counts.get("Cancelled by Driver", 0)
+    cancelled_customer = status_counts.get("Cancelled by Customer", 0)
+    no_driver = status_counts.get("No Driver Found", 0)
+    incomplete = status_counts.get("Incomplete", 0)
+    avg_distance = totals['dsum'] / totals['dcnt'] if totals['dcnt'] else 0
+    avg_driver_rating = totals['rsum'] / totals['rcnt'] if totals['rcnt'] else 0
+
+    values = [total_rides, completed, cancelled_driver, cancelled_customer, no_driver, incomplete,
+              round(avg_distance,2), round(avg_driver_rating,2)]
+    with pn.io.hold():
+        for name, value in zip(METRIC_NAMES, values):
+            metric_numbers[name].value = value
+
+    # return metrics_row
     return pn.Row()
 
 # =================== Charts ===================
-def ride_status_chart(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    return df['Booking Status'].value_counts().hvplot.bar(title="Ride Status", rot=45, height=250, responsive=True)
+def ride_status_chart(df):
+    codes = df['Booking Status'].cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(status_categories))
+    status_counts = pd.Series(counts, index=pd.Index(status_categories, name='Booking Status'), name='count')
+    # Only statuses present in the selection, as value_counts on the raw strings gave
+    status_counts = status_counts[status_counts > 0]
+    return status_counts.sort_values(ascending=False).hvplot.bar(title="Ride Status", rot=45, height=250, responsive=True)
 
 def rides_over_time_chart(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    rides_by_hour = df.groupby('Hour').size()
+    start_hour, end_hour = hour_range
+    counts = ride_counts[code_slice(status_categories, status), code_slice(vehicle_categories, vehicle)]
+    rides_by_hour = pd.Series(counts.sum(axis=(0, 1))[start_hour:end_hour + 1],
+                              index=pd.RangeIndex(start_hour, end_hour + 1, name='Hour'))
     return rides_by_hour.hvplot.line(title="Rides by Hour", ylabel="Number of Rides", xlabel="Hour", height=250, responsive=True)
 
 def ride_distance_histogram(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    return df['Ride Distance'].hvplot.hist(bins=20, title="Ride Distance Distribution", height=250, responsive=True)
-
-def scatter_distance_rating(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
+    start_hour, end_hour = hour_range
+    counts = distance_hist[code_slice(status_categories, status), code_slice(vehicle_categories, vehicle),
+                           start_hour:end_hour + 1]
+    return hv.Histogram((distance_edges, counts.sum(axis=(0, 1, 2))), kdims=['Ride Distance'], vdims=['Count']) \
+             .opts(title="Ride Distance Distribution", height=250, responsive=True)
+
+SCATTER_MAX_POINTS = 5000
+
+def scatter_distance_rating(df):
+    # Rides without a distance or driver rating have no point to draw
+    df = df.dropna(subset=['Ride Distance', 'Driver Ratings'])
+    if len(df) > SCATTER_MAX_POINTS:
+        # Proportional sample within each Customer Rating bucket keeps the colour mix
+        rating_bucket = df['Customer Rating'].round()
+        df = df.groupby(rating_bucket).sample(frac=SCATTER_MAX_POINTS / len(df), random_state=0)
     return df.hvplot.scatter(x='Ride Distance', y='Driver Ratings', c='Customer Rating', cmap='Viridis',
                              size=40, title="Distance vs Driver Ratings", height=250, responsive=True)
 
 def top_pickup_locations_map(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    top_locations = df['Pickup Location'].value_counts().head(10).reset_index()
-    top_locations.columns = ['Pickup Location','Count']
-    return top_locations.hvplot.bar(x='Pickup Location', y='Count', rot=45, title="Top 10 Pickup Locations", height=250, responsive=True)
+    top_pickup = top_locations(pickup_cube, status, vehicle, hour_range, 10).reset_index()
+    top_pickup.columns = ['Pickup Location','Count']
+    return top_pickup.hvplot.bar(x='Pickup Location', y='Count', rot=45, title="Top 10 Pickup Locations", height=250, responsive=True)
 
-def forecast_future_bookings(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    daily_rides = df.groupby('Date').size().reset_index(name='y')
-    daily_rides['ds'] = pd.to_datetime(daily_rides['Date'])
+def daily_ride_counts(status, vehicle, hour_range):
+    start_hour, end_hour = hour_range
+    counts = daily_counts[:, code_slice(status_categories, status), code_slice(vehicle_categories, vehicle),
+                          start_hour:end_hour + 1].sum(axis=(1, 2, 3))
+    # Only days with rides, as a groupby over the filtered rows would give
+    has_rides = counts > 0
+    return pd.DataFrame({'ds': pd.to_datetime(date_categories[has_rides]), 'y': counts[has_rides]})
+
+# pn.cache is shared by every session in the server process, unlike lru_cache on
+# this script, which Panel re-runs per session
+@pn.cache(max_items=64)
+def fit_forecast(status, vehicle, hour_range):
+    daily_rides = daily_ride_counts(status, vehicle, hour_range)
 
     if len(daily_rides) < 5:
-        return pn.pane.Markdown("⚠️ Not enough data to forecast.")
+        return None
 
-    model = Prophet()
-    model.fit(daily_rides[['ds','y']])
+    # Point forecast only: skip uncertainty sampling and use Stan's Newton optimizer
+    model = Prophet(uncertainty_samples=0)
+    model.fit(daily_rides[['ds','y']], algorithm='Newton')
 
     future = model.make_future_dataframe(periods=30)
     forecast = model.predict(future)
+    return daily_rides[['ds','y']], forecast[['ds','yhat']]
+
+def forecast_future_bookings(status, vehicle, hour_range):
+    result = fit_forecast(status, vehicle, hour_range)
+    if result is None:
+        return pn.pane.Markdown("⚠️ Not enough data to forecast.")
+    daily_rides, forecast = result
 
     chart = forecast.hvplot.line(x='ds', y='yhat', label='Forecast', color='orange') * \
             daily_rides.hvplot.line(x='ds', y='y', label='Actual', color='blue')
@@ -116,9 +282,8 @@ def forecast_future_bookings(status, vehicle, hour_range):
     return chart.opts(title="📈 Future Client Bookings Forecast", responsive=True, height=300)
 
 def top_places_chart(status, vehicle, hour_range):
-    df = filter_data(status, vehicle, hour_range)
-    top_pickup = df['Pickup Location'].value_counts().head(5)
-    top_drop = df['Drop Location'].value_counts().head(5)
+    top_pickup = top_locations(pickup_cube, status, vehicle, hour_range, 5)
+    top_drop = top_locations(drop_cube, status, vehicle, hour_range, 5)
 
     data = pd.DataFrame({
         'Location': top_pickup.index.tolist() + top_drop.index.tolist(),
@@ -134,15 +299,22 @@ def interactive_table():
     return pn.widgets.Tabulator(df_uber_small, pagination='remote', page_size=15, sizing_mode='stretch_width', height=425)
 
 # =================== Page Layout ===================
+def dynamic_chart(bound_chart):
+    # Update the existing Bokeh plot in place; framewise rescales axes per update
+    return hv.DynamicMap(bound_chart).opts(framewise=True)
+
 def create_page1():
+    # Row-level charts share one filtered frame per widget change
+    filtered_df = pn.bind(filter_data, status_select, vehicle_select, hour_slider)
+
     charts_row1 = pn.Row(
-        pn.bind(ride_status_chart, status_select, vehicle_select, hour_slider),
-        pn.bind(rides_over_time_chart, status_select, vehicle_select, hour_slider),
+        dynamic_chart(pn.bind(ride_status_chart, filtered_df)),
+        dynamic_chart(pn.bind(rides_over_time_chart, status_select, vehicle_select, hour_slider)),
         sizing_mode='stretch_width'
     )
     charts_row2 = pn.Row(
-        pn.bind(ride_distance_histogram, status_select, vehicle_select, hour_slider),
-        pn.bind(scatter_distance_rating, status_select, vehicle_select, hour_slider),
+        dynamic_chart(pn.bind(ride_distance_histogram, status_select, vehicle_select, hour_slider)),
+        dynamic_chart(pn.bind(scatter_distance_rating, filtered_df)),
         sizing_mode='stretch_width'
     )
     
@@ -151,9 +323,9 @@ def create_page1():
         pn.bind(summary_metrics, status_select, vehicle_select, hour_slider),
         charts_row1,
         charts_row2,
-        pn.bind(top_pickup_locations_map, status_select, vehicle_select, hour_slider),
+        dynamic_chart(pn.bind(top_pickup_locations_map, status_select, vehicle_select, hour_slider)),
         pn.bind(forecast_future_bookings, status_select, vehicle_select, hour_slider),
-        pn.bind(top_places_chart, status_select, vehicle_select, hour_slider),
+        dynamic_chart(pn.bind(top_places_chart, status_select, vehicle_select, hour_slider)),
         sizing_mode='stretch_width'
     )
 